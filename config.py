@@ -0,0 +1,34 @@
+import os
+from dotenv import load_dotenv
+
+# Load env
+load_dotenv()
+
+# -------- LLM --------
+MODEL_NAME = os.getenv("MODEL_NAME", "google/gemini-2.0-flash-exp:free")
+
+# Bump this whenever the prompts in services/ai_response.py change so that
+# answers produced by an older prompt are no longer served from the cache.
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "1")
+
+# Cached rows are tagged with this value and ignored once it changes
+CACHE_VERSION = f"{MODEL_NAME}:{PROMPT_VERSION}"
+
+# -------- CACHE --------
+# Max cached queries kept per invoice and across all invoices (0 = unlimited)
+QUERY_CACHE_MAX_PER_INVOICE = int(os.getenv("QUERY_CACHE_MAX_PER_INVOICE", "50"))
+QUERY_CACHE_MAX_ROWS = int(os.getenv("QUERY_CACHE_MAX_ROWS", "10000"))
+
+# Max cached summaries (0 = unlimited)
+SUMMARY_CACHE_MAX_ROWS = int(os.getenv("SUMMARY_CACHE_MAX_ROWS", "5000"))
+
+# Entries older than this are treated as missing and purged (0 = never expire)
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(30 * 24 * 60 * 60)))
+
+# Eviction policy once a cap is reached: "lru" (least recently used) or "lfu" (least frequently used)
+CACHE_EVICTION_POLICY = os.getenv("CACHE_EVICTION_POLICY", "lru").lower()
+if CACHE_EVICTION_POLICY not in {"lru", "lfu"}:
+    raise ValueError(f"CACHE_EVICTION_POLICY must be 'lru' or 'lfu', got '{CACHE_EVICTION_POLICY}'")
+
+# Similarity above which two cached queries for the same invoice are merged by compaction
+CACHE_COMPACTION_THRESHOLD = float(os.getenv("CACHE_COMPACTION_THRESHOLD", "0.9"))
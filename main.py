@@ -1,43 +1,59 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, Query
 from services.document_parser import extract_text_from_pdf
-from models.database import qdrant, collection_name
-from models.embeddings import get_text_embedding
-from services.query_handler import handle_query, get_invoice_id_by_filename,handle_summary
+from models.database import collection_name, invalidate_invoice_cache
+from models.embeddings import get_text_embedding_async, shutdown_embedding_executor
+from services.query_handler import handle_query_async, get_invoice_id_by_filename_async, handle_summary_async
 import uuid
-from services.gsheets_logger import append_invoice_data
-from services.query_handler import handle_field_extraction
+from services.gsheets_logger import append_invoice_data_async
+from services.query_handler import handle_field_extraction_async
+from services.retrieval import get_async_qdrant, close_async_qdrant
+from services.ai_response import close_async_client
 
-app = FastAPI(title="AI Invoice Parser & RAG Agent")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release pooled connections and worker threads on shutdown; they are
+    # recreated on first use if the app is started again in this process
+    await close_async_client()
+    await close_async_qdrant()
+    shutdown_embedding_executor()
+
+
+app = FastAPI(title="AI Invoice Parser & RAG Agent", lifespan=lifespan)
 
 
 @app.get("/")
-def home():
+async def home():
     return {"message": "Welcome to the AI Invoice Parser & RAG System!"}
 
 
 @app.post("/upload")
 async def upload_invoice(file: UploadFile = File(...)):
-    """Handles invoice file uploads, extracts text, and avoids duplicates."""
+    """
+    Handles invoice file uploads and extracts text. Re-uploading an existing filename
+    replaces the stored document in place (same invoice ID) instead of duplicating it.
+    """
 
     # Check if invoice already exists
-    existing_invoice_id = get_invoice_id_by_filename(file.filename)
-    if existing_invoice_id:
-        return {
-            "message": f"Invoice '{file.filename}' already exists in Qdrant.",
-            "invoice_id": existing_invoice_id,
-        }
+    existing_invoice_id = await get_invoice_id_by_filename_async(file.filename)
 
     file_bytes = await file.read()
-    extracted_text = extract_text_from_pdf(file_bytes)
+    extracted_text = await asyncio.to_thread(extract_text_from_pdf, file_bytes)
 
     # Generate embeddings
-    embedding_vector = get_text_embedding(extracted_text)
+    embedding_vector = await get_text_embedding_async(extracted_text)
 
-    # Generate a unique UUID
-    invoice_id = str(uuid.uuid4())  # Qdrant requires int or UUID
+    if existing_invoice_id:
+        invoice_id = existing_invoice_id
+    else:
+        # Generate a unique UUID
+        invoice_id = str(uuid.uuid4())  # Qdrant requires int or UUID
 
     # Store in Qdrant
-    qdrant.upsert(
+    await get_async_qdrant().upsert(
         collection_name=collection_name,
         points=[
             {
@@ -48,37 +64,44 @@ async def upload_invoice(file: UploadFile = File(...)):
         ],
     )
 
+    if existing_invoice_id:
+        # Answers and summary cached for the previous version are no longer valid. This runs
+        # only after the upsert succeeded, so requests served in between cannot re-cache
+        # answers from the old document.
+        await asyncio.to_thread(invalidate_invoice_cache, file.filename)
+        return {"message": f"Invoice '{file.filename}' replaced and its cache cleared.", "filename": file.filename, "invoice_id": invoice_id}
+
     return {"message": "Invoice uploaded successfully.", "filename": file.filename, "invoice_id": invoice_id}
 
 
 @app.get("/ask")
-def ask_ai(
+async def ask_ai(
     filename: str = Query(..., description="Filename of the invoice"),
     query: str = Query(..., description="Ask a question about an invoice"),
 ):
     """
     API endpoint to process user queries using filename instead of invoice ID.
     """
-    response = handle_query(filename, query)
+    response = await handle_query_async(filename, query)
     return response
 
 
 @app.get("/summarize")
-def summarize_invoice(filename: str):
-    return handle_summary(filename)
+async def summarize_invoice(filename: str):
+    return await handle_summary_async(filename)
 
 @app.get("/extract-fields")
-def extract_fields(filename: str, sheet: str = "Invoice Logs"):
+async def extract_fields(filename: str, sheet: str = "Invoice Logs"):
     """
     Extract structured invoice fields and log them into a Google Sheet.
     """
-    result = handle_field_extraction(filename)
+    result = await handle_field_extraction_async(filename)
 
     if "error" in result:
         return result
 
     #  Log to Google Sheet
-    append_invoice_data(sheet, result)
+    await append_invoice_data_async(sheet, result)
 
     return {"message": "Structured fields extracted and logged successfully.", "fields": result}
 
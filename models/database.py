@@ -9,6 +9,10 @@ from rapidfuzz import fuzz, process
 import nltk
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
+from config import (
+    CACHE_VERSION, CACHE_TTL_SECONDS, CACHE_EVICTION_POLICY, CACHE_COMPACTION_THRESHOLD,
+    QUERY_CACHE_MAX_PER_INVOICE, QUERY_CACHE_MAX_ROWS, SUMMARY_CACHE_MAX_ROWS,
+)
 
 # SQLite Database File
 DB_FILE = "invoice_cache.db"
@@ -44,6 +48,13 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+# Add columns introduced after the first release to existing databases
+def _ensure_columns(cursor, table, columns):
+    existing = {row["name"] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
 # Initialize SQLite database & tables
 def initialize_sqlite():
     conn = get_db_connection()
@@ -70,18 +81,97 @@ def initialize_sqlite():
         )
     ''')
 
+    # Bookkeeping for eviction, TTL and version invalidation. Rows cached before
+    # these columns existed have no version (''), so the startup invalidation
+    # below clears them: upgrading an old database starts from an empty cache.
+    cache_columns = {
+        "hit_count": "INTEGER NOT NULL DEFAULT 0",
+        "last_accessed": "TIMESTAMP",
+        "cache_version": "TEXT NOT NULL DEFAULT ''",
+    }
+    _ensure_columns(cursor, "query_cache", {**cache_columns, "query_embedding": "BLOB"})
+    _ensure_columns(cursor, "invoice_summaries", cache_columns)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_query_cache_invoice ON query_cache (invoice_id, cache_version)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_query_cache_created ON query_cache (created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoice_summaries_created ON invoice_summaries (created_at)")
+
     conn.commit()
     conn.close()
 
-# Store API responses in cache
-def cache_response(invoice_id, query, response):
+    # Entries produced by another model / prompt version (or unversioned legacy rows) can never be served again
+    invalidate_stale_versions()
+    purge_expired_cache()
+
+# -------- CACHE HELPERS --------
+def _ttl_modifier():
+    """SQLite datetime() modifier for the oldest still-valid created_at."""
+    return f"-{CACHE_TTL_SECONDS} seconds"
+
+def _fresh_clause():
+    """WHERE fragment matching rows that are neither expired nor from another version."""
+    if CACHE_TTL_SECONDS > 0:
+        return "cache_version = ? AND created_at >= datetime('now', ?)", [CACHE_VERSION, _ttl_modifier()]
+    return "cache_version = ?", [CACHE_VERSION]
+
+def _keep_order():
+    """ORDER BY clause ranking rows from most to least worth keeping."""
+    recency = "COALESCE(last_accessed, created_at) DESC, id DESC"
+    if CACHE_EVICTION_POLICY == "lfu":
+        return f"hit_count DESC, {recency}"
+    return recency
+
+def _evict_beyond(cursor, table, limit, new_id, where="1 = 1", params=()):
+    """
+    Trim a table to `limit` rows. The row just inserted (new_id) always survives,
+    otherwise under LFU a fresh entry with no hits would be evicted immediately.
+    """
+    if limit <= 0:
+        return
+    cursor.execute(
+        f"""DELETE FROM {table} WHERE id IN (
+                SELECT id FROM {table} WHERE {where} AND id != ?
+                ORDER BY {_keep_order()} LIMIT -1 OFFSET ?
+            )""",
+        (*params, new_id, limit - 1)
+    )
+
+def _enforce_query_cache_limits(cursor, invoice_id, new_id):
+    _evict_beyond(cursor, "query_cache", QUERY_CACHE_MAX_PER_INVOICE, new_id, "invoice_id = ?", (invoice_id,))
+    _evict_beyond(cursor, "query_cache", QUERY_CACHE_MAX_ROWS, new_id)
+
+def _invoice_id_variants(invoice_id):
+    invoice_id = invoice_id.lower().strip()
+    base = invoice_id[:-4] if invoice_id.endswith(".pdf") else invoice_id
+    return [base, f"{base}.pdf"]
+
+def embed_cache_query(query):
+    """Embedding used to match cached queries. Compute once and pass to match_cached_query and cache_response."""
+    return np.asarray(embedding_model.embed_query(preprocess_query(query)), dtype=np.float32)
+
+def _query_similarity(query_a, embedding_a, query_b, embedding_b):
+    fuzzy_similarity = fuzz.ratio(query_a.lower(), query_b.lower()) / 100
+    embedding_similarity = cosine_similarity(embedding_a, embedding_b)
+    return (0.7 * fuzzy_similarity) + (0.3 * embedding_similarity)
+
+def _load_embedding(row):
+    return np.frombuffer(row["query_embedding"], dtype=np.float32)
+
+# Store API responses in cache (near-duplicates are merged later by compact_query_cache)
+def cache_response(invoice_id, query, response, query_embedding=None):
+    if query_embedding is None:
+        query_embedding = embed_cache_query(query)
+
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
-            "INSERT INTO query_cache (invoice_id, query, response) VALUES (?, ?, ?)",
-            (invoice_id, query, response)
+            """INSERT INTO query_cache
+               (invoice_id, query, response, query_embedding, cache_version, last_accessed)
+               VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
+            (invoice_id, query, response, query_embedding.tobytes(), CACHE_VERSION)
         )
+        _enforce_query_cache_limits(cursor, invoice_id, cursor.lastrowid)
         conn.commit()
     except sqlite3.OperationalError as e:
         print(f" Database Lock Error (cache_response): {e}")
@@ -95,9 +185,11 @@ def cache_invoice_summary(invoice_id, summary):
     cursor = conn.cursor()
     try:
         cursor.execute(
-            "INSERT OR REPLACE INTO invoice_summaries (invoice_id, summary) VALUES (?, ?)",
-            (invoice_id, summary)
+            """INSERT OR REPLACE INTO invoice_summaries (invoice_id, summary, cache_version, last_accessed)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (invoice_id, summary, CACHE_VERSION)
         )
+        _evict_beyond(cursor, "invoice_summaries", SUMMARY_CACHE_MAX_ROWS, cursor.lastrowid)
         conn.commit()
     except sqlite3.OperationalError as e:
         print(f" Database Lock Error (cache_invoice_summary): {e}")
@@ -110,12 +202,25 @@ def get_invoice_summary(invoice_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
+        fresh, params = _fresh_clause()
         cursor.execute(
-            "SELECT summary FROM invoice_summaries WHERE invoice_id = ?",
-            (invoice_id,)
+            f"SELECT id, summary FROM invoice_summaries WHERE invoice_id = ? AND {fresh}",
+            (invoice_id, *params)
         )
         result = cursor.fetchone()
-        return result["summary"] if result else None
+        if not result:
+            return None
+
+        # Hit tracking is best effort: a locked database must not turn a hit into a miss
+        try:
+            cursor.execute(
+                "UPDATE invoice_summaries SET hit_count = hit_count + 1, last_accessed = CURRENT_TIMESTAMP WHERE id = ?",
+                (result["id"],)
+            )
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f" Database Lock Error (get_invoice_summary hit count): {e}")
+        return result["summary"]
     except sqlite3.OperationalError as e:
         print(f" Database Lock Error (get_invoice_summary): {e}")
         return None
@@ -123,6 +228,52 @@ def get_invoice_summary(invoice_id):
         cursor.close()
         conn.close()
 
+# -------- INVALIDATION --------
+def invalidate_invoice_cache(invoice_id):
+    """Drop cached answers and summary for an invoice, e.g. when it is re-uploaded."""
+    variants = _invoice_id_variants(invoice_id)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for table in ("query_cache", "invoice_summaries"):
+            cursor.execute(f"DELETE FROM {table} WHERE LOWER(TRIM(invoice_id)) IN (?, ?)", variants)
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        print(f" Database Lock Error (invalidate_invoice_cache): {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+def invalidate_stale_versions():
+    """Drop entries generated by a different model or prompt version."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for table in ("query_cache", "invoice_summaries"):
+            cursor.execute(f"DELETE FROM {table} WHERE cache_version != ?", (CACHE_VERSION,))
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        print(f" Database Lock Error (invalidate_stale_versions): {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+def purge_expired_cache():
+    """Drop entries older than CACHE_TTL_SECONDS."""
+    if CACHE_TTL_SECONDS <= 0:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for table in ("query_cache", "invoice_summaries"):
+            cursor.execute(f"DELETE FROM {table} WHERE created_at < datetime('now', ?)", (_ttl_modifier(),))
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        print(f" Database Lock Error (purge_expired_cache): {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
 # Preprocessing and NLP setup
 nltk.download("stopwords")
 nltk.download("wordnet")
@@ -158,44 +309,156 @@ def correct_query_spelling(query, common_queries):
         return best_match if score > 85 else query
     return query
 
-def get_cached_response(invoice_id, user_query, similarity_threshold=0.65):
+
+# Lookup is split into SQLite-only and CPU-only steps so async callers can run each
+# on the right executor; get_cached_response chains them for sync callers.
+def get_cached_queries(invoice_id):
+    """Fresh cached query rows for an invoice."""
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT query, response FROM query_cache WHERE invoice_id = ?", (invoice_id,))
-        cached_data = cursor.fetchall()
+        fresh, params = _fresh_clause()
+        cursor.execute(
+            f"SELECT id, query, response, query_embedding FROM query_cache WHERE invoice_id = ? AND {fresh}",
+            (invoice_id, *params)
+        )
+        return cursor.fetchall()
     except sqlite3.OperationalError as e:
-        print(f" Database Lock Error (get_cached_response): {e}")
+        print(f" Database Lock Error (get_cached_queries): {e}")
+        return []
+    finally:
+        cursor.close()
+        conn.close()
+
+def match_cached_query(cached_rows, user_query, query_embedding, similarity_threshold=0.65):
+    """Return the most similar cached row if it clears the threshold, else None."""
+    best_match = None
+    highest_similarity = 0
+
+    for row in cached_rows:
+        similarity = _query_similarity(user_query, query_embedding, row["query"], _load_embedding(row))
+        print(f" Checking '{user_query}' vs '{row['query']}' | Similarity: {similarity:.2f}")
+
+        if similarity > highest_similarity:
+            highest_similarity = similarity
+            best_match = row
+
+    if best_match is None or highest_similarity < similarity_threshold:
         return None
+
+    print(f" Found similar cached query with {highest_similarity:.2f} similarity.")
+    return best_match
+
+def record_cache_hit(cache_id):
+    """Bump hit_count / last_accessed. Best effort: failures are logged, never raised."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE query_cache SET hit_count = hit_count + 1, last_accessed = CURRENT_TIMESTAMP WHERE id = ?",
+            (cache_id,)
+        )
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        print(f" Database Lock Error (record_cache_hit): {e}")
     finally:
+        cursor.close()
         conn.close()
 
-    if not cached_data:
+def get_cached_response(invoice_id, user_query, similarity_threshold=0.65, query_embedding=None):
+    cached_rows = get_cached_queries(invoice_id)
+    if not cached_rows:
         return None
 
-    query_embedding = embedding_model.embed_query(preprocess_query(user_query))
-    best_match = None
-    highest_similarity = 0
+    if query_embedding is None:
+        query_embedding = embed_cache_query(user_query)
 
-    for cached_query, response in cached_data:
-        cached_query_processed = preprocess_query(cached_query)
-        cached_embedding = embedding_model.embed_query(cached_query_processed)
+    best_match = match_cached_query(cached_rows, user_query, query_embedding, similarity_threshold)
+    if best_match is None:
+        return None
 
-        fuzzy_similarity = fuzz.ratio(user_query.lower(), cached_query.lower()) / 100
-        embedding_similarity = cosine_similarity(query_embedding, cached_embedding)
+    record_cache_hit(best_match["id"])
+    return best_match["response"]
 
-        similarity = (0.7 * fuzzy_similarity) + (0.3 * embedding_similarity)
-        print(f" Checking '{user_query}' vs '{cached_query}' | Similarity: {similarity:.2f}")
+# -------- COMPACTION --------
+def compact_query_cache(similarity_threshold=CACHE_COMPACTION_THRESHOLD):
+    """
+    Merge semantically duplicate cached queries per invoice and reclaim disk space.
 
-        if similarity > highest_similarity:
-            highest_similarity = similarity
-            best_match = response
+    The entry ranked highest by the eviction policy survives and absorbs the hit
+    counts of its duplicates. Returns the number of rows removed.
+    """
+    purge_expired_cache()
+    invalidate_stale_versions()
 
-    if highest_similarity >= similarity_threshold:
-        print(f" Found similar cached query with {highest_similarity:.2f} similarity.")
-        return best_match
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    removed = 0
+    try:
+        cursor.execute("SELECT DISTINCT invoice_id FROM query_cache")
+        invoice_ids = [row["invoice_id"] for row in cursor.fetchall()]
+
+        for invoice_id in invoice_ids:
+            cursor.execute(
+                f"""SELECT id, query, hit_count, query_embedding FROM query_cache
+                    WHERE invoice_id = ? ORDER BY {_keep_order()}""",
+                (invoice_id,)
+            )
+            kept = []  # (id, query, embedding)
+            for row in cursor.fetchall():
+                embedding = _load_embedding(row)
+                duplicate_of = next(
+                    (
+                        kept_id for kept_id, kept_query, kept_embedding in kept
+                        if _query_similarity(row["query"], embedding, kept_query, kept_embedding) >= similarity_threshold
+                    ),
+                    None
+                )
+                if duplicate_of is None:
+                    kept.append((row["id"], row["query"], embedding))
+                    continue
+
+                cursor.execute(
+                    "UPDATE query_cache SET hit_count = hit_count + ? WHERE id = ?",
+                    (row["hit_count"], duplicate_of)
+                )
+                cursor.execute("DELETE FROM query_cache WHERE id = ?", (row["id"],))
+                removed += 1
+
+        conn.commit()
+        cursor.execute("VACUUM")
+    except sqlite3.OperationalError as e:
+        print(f" Database Lock Error (compact_query_cache): {e}")
+    finally:
+        cursor.close()
+        conn.close()
 
-    return None
+    print(f" Compaction removed {removed} duplicate cached queries.")
+    return removed
 
 # Run init
 initialize_sqlite()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the invoice cache database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = subparsers.add_parser("compact", help="Merge duplicate cached queries and vacuum the database.")
+    compact_parser.add_argument("--threshold", type=float, default=CACHE_COMPACTION_THRESHOLD)
+
+    subparsers.add_parser("purge", help="Drop expired and stale-version entries.")
+
+    invalidate_parser = subparsers.add_parser("invalidate", help="Drop cached entries for one invoice.")
+    invalidate_parser.add_argument("invoice_id")
+
+    args = parser.parse_args()
+    if args.command == "compact":
+        compact_query_cache(args.threshold)
+    elif args.command == "purge":
+        purge_expired_cache()
+        invalidate_stale_versions()
+    elif args.command == "invalidate":
+        invalidate_invoice_cache(args.invoice_id)
@@ -1,9 +1,36 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer
 import numpy as np
 
 # Load embedding model
 embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
 
+# Dedicated pool for CPU-bound encoding so it never competes with I/O offloads.
+# Created lazily so the app can start again after a shutdown in the same process.
+_embedding_executor = None
+
+def get_embedding_executor():
+    global _embedding_executor
+    if _embedding_executor is None:
+        _embedding_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="embedding")
+    return _embedding_executor
+
+def shutdown_embedding_executor():
+    global _embedding_executor
+    if _embedding_executor is not None:
+        _embedding_executor.shutdown(wait=False)
+        _embedding_executor = None
+
 def get_text_embedding(text: str) -> np.ndarray:
     """Generate embeddings for invoice text."""
     return embedding_model.encode(text).tolist()
+
+async def run_embedding(func, *args):
+    """Run a CPU-bound embedding call on the dedicated embedding pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_embedding_executor(), func, *args)
+
+async def get_text_embedding_async(text: str) -> np.ndarray:
+    """Generate embeddings for invoice text without blocking the event loop."""
+    return await run_embedding(get_text_embedding, text)
@@ -1,12 +1,13 @@
 import os
 import requests
+import httpx
 from dotenv import load_dotenv
 import json
+from config import MODEL_NAME
 
 # Load env
 load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-MODEL_NAME = "google/gemini-2.0-flash-exp:free"
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
@@ -15,9 +16,64 @@ headers = {
     "Content-Type": "application/json"
 }
 
+NOT_AN_INVOICE = "The uploaded document does not appear to be an invoice."
+
+# Shared async client so concurrent requests reuse pooled connections.
+# Created lazily so the app can start again after close_async_client().
+_async_client = None
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_connections=500, max_keepalive_connections=100),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+# -------- CONTEXT --------
+def build_context(retrieved_docs):
+    return "\n".join([doc.payload["text"] for doc in retrieved_docs])
+
+
+def looks_like_invoice(context):
+    #  Sanity check: Reject if it doesn’t seem to be an invoice
+    return "invoice" in context.lower()
+
+
+def prepare_summary_context(retrieved_docs):
+    """
+    Returns (context, rejection). rejection is the summary result to return as-is
+    when the document does not look like an invoice, otherwise None.
+    """
+    context = build_context(retrieved_docs)
+    if not looks_like_invoice(context):
+        return context, {"text": NOT_AN_INVOICE, "context": context, "query": "Summarize this invoice."}
+    return context, None
+
+
+def prepare_fields_context(retrieved_docs):
+    """
+    Returns (context, error). error is set when the document does not look like an invoice.
+    """
+    context = build_context(retrieved_docs)
+    if not looks_like_invoice(context):
+        return context, {"error": NOT_AN_INVOICE}
+    return context, None
+
 # -------- QUERY RESPONSE --------
-def generate_ai_response(query, retrieved_docs):
-    context = "\n".join([doc.payload["text"] for doc in retrieved_docs])
+def build_query_payload(query, retrieved_docs):
+    context = build_context(retrieved_docs)
 
     prompt = f"""
 You are an AI assistant that processes invoices.
@@ -42,26 +98,41 @@ User Query:
         "temperature": 0.3,
         "max_tokens": 150
     }
+    return payload
 
-    response = requests.post(OPENROUTER_URL, headers=headers, json=payload)
 
-    if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"]
+def parse_query_response(status_code, data, text):
+    """
+    Returns the answer text, or an {"error": ...} dict (like the summary and field
+    extractors) so callers can tell a failure apart from an answer and not cache it.
+    """
+    if status_code == 200:
+        return data["choices"][0]["message"]["content"]
     else:
-        return f" Error from OpenRouter: {response.text}"
+        return {"error": f" Error from OpenRouter: {text}"}
 
-# -------- INVOICE SUMMARY --------
-def generate_summary(invoice_id, retrieved_docs):
-    context = "\n".join([doc.payload["text"] for doc in retrieved_docs])
 
-    #  Sanity check: Reject if it doesn’t seem to be an invoice
-    if "invoice" not in context.lower():
-        return {
-            "text": "The uploaded document does not appear to be an invoice.",
-            "context": context,
-            "query": "Summarize this invoice."
-        }
+def generate_ai_response(query, retrieved_docs):
+    payload = build_query_payload(query, retrieved_docs)
+    try:
+        response = requests.post(OPENROUTER_URL, headers=headers, json=payload)
+        data = response.json() if response.status_code == 200 else None
+    except requests.exceptions.RequestException as e:
+        return {"error": f" Error from OpenRouter: {str(e)}"}
+    return parse_query_response(response.status_code, data, response.text)
 
+
+async def generate_ai_response_async(query, retrieved_docs):
+    payload = build_query_payload(query, retrieved_docs)
+    try:
+        response = await get_async_client().post(OPENROUTER_URL, json=payload)
+        data = response.json() if response.status_code == 200 else None
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        return {"error": f" Error from OpenRouter: {str(e)}"}
+    return parse_query_response(response.status_code, data, response.text)
+
+# -------- INVOICE SUMMARY --------
+def build_summary_payload(context):
     prompt = f"""
 Summarize the following invoice in 2-3 sentences. Highlight:
 - Invoice number
@@ -81,29 +152,53 @@ Invoice:
         "temperature": 0.3,
         "max_tokens": 150
     }
+    return payload
+
+
+def parse_summary_response(json_data, context):
+    summary = json_data["choices"][0]["message"]["content"]
+    return {
+        "text": summary.strip(),
+        "context": context,
+        "query": "Summarize this invoice."
+    }
+
+
+def generate_summary(invoice_id, retrieved_docs):
+    context, rejection = prepare_summary_context(retrieved_docs)
+    if rejection:
+        return rejection
+
+    payload = build_summary_payload(context)
 
     try:
         response = requests.post(OPENROUTER_URL, headers=headers, json=payload)
         response.raise_for_status()
-        summary = response.json()["choices"][0]["message"]["content"]
-        return {
-            "text": summary.strip(),
-            "context": context,
-            "query": "Summarize this invoice."
-        }
+        return parse_summary_response(response.json(), context)
     except requests.exceptions.RequestException as e:
         return {
             "error": f" OpenRouter API call failed: {str(e)}"
         }
 
 
-def generate_structured_fields(filename, retrieved_docs):
-    context = "\n".join([doc.payload["text"] for doc in retrieved_docs])
+async def generate_summary_async(invoice_id, retrieved_docs):
+    context, rejection = prepare_summary_context(retrieved_docs)
+    if rejection:
+        return rejection
+
+    payload = build_summary_payload(context)
+
+    try:
+        response = await get_async_client().post(OPENROUTER_URL, json=payload)
+        response.raise_for_status()
+        return parse_summary_response(response.json(), context)
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        return {
+            "error": f" OpenRouter API call failed: {str(e)}"
+        }
 
-    #  Sanity check to ensure the document is actually an invoice
-    if "invoice" not in context.lower():
-        return {"error": "The uploaded document does not appear to be an invoice."}
 
+def build_fields_payload(context):
     prompt = f"""
     Extract the following structured fields from the invoice below:
 
@@ -141,29 +236,58 @@ def generate_structured_fields(filename, retrieved_docs):
         "temperature": 0.3,
         "max_tokens": 150,
     }
+    return payload
+
+
+def parse_structured_fields(json_data, filename):
+    raw_content = json_data["choices"][0]["message"]["content"]
+
+    print(" Raw AI Response:\n", raw_content)
+
+    #  Strip markdown-style backticks and label if present
+    #  Remove triple backticks and optional "json" language tag
+    if raw_content.strip().startswith("```"):
+        raw_content = raw_content.strip().strip("```").strip()
+        if raw_content.lower().startswith("json"):
+            raw_content = raw_content[4:].strip()
+
+    extracted_fields = json.loads(raw_content)
+
+    extracted_fields["Filename"] = filename
+    return extracted_fields
+
+
+def generate_structured_fields(filename, retrieved_docs):
+    context, error = prepare_fields_context(retrieved_docs)
+    if error:
+        return error
+
+    payload = build_fields_payload(context)
 
     try:
         response = requests.post(OPENROUTER_URL, headers=headers, json=payload)
         response.raise_for_status()
+        return parse_structured_fields(response.json(), filename)
 
-        json_data = response.json()
-        raw_content = json_data["choices"][0]["message"]["content"]
+    except requests.exceptions.RequestException as e:
+        return {"error": f" OpenRouter API failed: {str(e)}"}
+    except json.JSONDecodeError as e:
+        return {"error": f" Failed to parse JSON response from AI model.\nReason: {str(e)}"}  # Add reason
 
-        print(" Raw AI Response:\n", raw_content)
 
-        #  Strip markdown-style backticks and label if present
-        #  Remove triple backticks and optional "json" language tag
-        if raw_content.strip().startswith("```"):
-            raw_content = raw_content.strip().strip("```").strip()
-            if raw_content.lower().startswith("json"):
-                raw_content = raw_content[4:].strip()
+async def generate_structured_fields_async(filename, retrieved_docs):
+    context, error = prepare_fields_context(retrieved_docs)
+    if error:
+        return error
 
-        extracted_fields = json.loads(raw_content)
+    payload = build_fields_payload(context)
 
-        extracted_fields["Filename"] = filename
-        return extracted_fields
+    try:
+        response = await get_async_client().post(OPENROUTER_URL, json=payload)
+        response.raise_for_status()
+        return parse_structured_fields(response.json(), filename)
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return {"error": f" OpenRouter API failed: {str(e)}"}
     except json.JSONDecodeError as e:
         return {"error": f" Failed to parse JSON response from AI model.\nReason: {str(e)}"}  # Add reason
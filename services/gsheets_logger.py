@@ -1,3 +1,4 @@
+import asyncio
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
@@ -19,6 +20,10 @@ def append_invoice_data(sheet_name: str, data: dict):
     sheet = get_sheet(sheet_name)
     sheet.append_row(list(data.values()))
 
+# gspread is blocking, so run it on a worker thread to keep the event loop free
+async def append_invoice_data_async(sheet_name: str, data: dict):
+    await asyncio.to_thread(append_invoice_data, sheet_name, data)
+
 
 # append_invoice_data("Invoice Logs",
 #     {
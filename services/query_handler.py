@@ -1,30 +1,67 @@
 from services.retrieval import retrieve_similar_docs
 from services.ai_response import generate_ai_response, generate_summary
-from models.database import get_cached_response, cache_response, qdrant, collection_name, COMMON_QUERIES
-from models.database import correct_query_spelling
+from models.database import get_cached_queries, match_cached_query, record_cache_hit
+from models.database import cache_response, qdrant, collection_name, COMMON_QUERIES
+from models.database import correct_query_spelling, embed_cache_query
 from models.database import get_invoice_summary, cache_invoice_summary
 from services.retrieval import retrieve_exact_doc_by_filename
 from services.ai_response import generate_structured_fields
+import asyncio
+from models.embeddings import run_embedding
+from services.retrieval import get_async_qdrant, match_filename
+from services.retrieval import retrieve_similar_docs_async, retrieve_exact_doc_by_filename_async
+from services.ai_response import generate_ai_response_async, generate_summary_async, generate_structured_fields_async
+from services.ai_response import build_context, looks_like_invoice, NOT_AN_INVOICE
 
 
-def get_invoice_id_by_filename(filename):
+# -------- SHARED STEPS --------
+# Used by both the sync handlers and their async variants below.
+
+def invoice_id_from_points(points, filename):
+    point = match_filename(points, filename)  # Checks with and without .pdf
+    if point:
+        print(" Match found!")
+        return point.id  # Extract and return the invoice UUID
+
+    print(" No match found.")
+    return None  # Return None if no match is found
+
+
+def correct_query(user_query):
+    corrected_query = correct_query_spelling(user_query, COMMON_QUERIES)
+    print(f" Corrected Query: '{user_query}' → '{corrected_query}'")
+    return corrected_query
+
+
+def check_summary_docs(retrieved_docs):
     """
-    Retrieve the invoice ID (UUID) from Qdrant by searching with the filename.
+    Returns the response to send as-is when no summary should be generated, otherwise None.
     """
-    results, _ = qdrant.scroll(collection_name=collection_name, limit=100)
+    if not retrieved_docs:
+        return {"error": "No relevant document found for summarization."}
 
-    filename = filename.lower().strip()  # Normalize input filename
-    possible_filenames = {filename, f"{filename}.pdf"}  # Check both versions
+    # Only invoices get summarized (and cached)
+    if not looks_like_invoice(build_context(retrieved_docs)):
+        return {"summary": NOT_AN_INVOICE}
 
-    for point in results:
-        stored_filename = point.payload.get("filename", "").lower().strip()
+    return None
 
-        if stored_filename in possible_filenames:
-            print(" Match found!")
-            return point.id  # Extract and return the invoice UUID
 
-    print(" No match found.")
-    return None  # Return None if no match is found
+def summary_text_from(summary_response):
+    # Only called with successful responses; failures carry an "error" key instead of "text"
+    # Extract plain text from the response
+    return summary_response["text"] if isinstance(summary_response["text"], str) else summary_response[
+        "text"].get("content", "")
+
+
+# -------- SYNC HANDLERS --------
+
+def get_invoice_id_by_filename(filename):
+    """
+    Retrieve the invoice ID (UUID) from Qdrant by searching with the filename.
+    """
+    results, _ = qdrant.scroll(collection_name=collection_name, limit=100)
+    return invoice_id_from_points(results, filename)
 
 
 def handle_query(invoice_id, user_query, top_k=3):
@@ -36,15 +73,21 @@ def handle_query(invoice_id, user_query, top_k=3):
     """
 
     #  Step 1: Check if query is already cached
-    corrected_query = correct_query_spelling(user_query, COMMON_QUERIES)
-    print(f" Corrected Query: '{user_query}' → '{corrected_query}'")
+    corrected_query = correct_query(user_query)
 
-    #  Use the corrected query for similarity checking
-    cached_response = get_cached_response(invoice_id, corrected_query)
+    #  Use the corrected query for similarity checking. It is only embedded when there
+    #  is something to compare against, and the embedding is reused when storing.
+    cached_rows = get_cached_queries(invoice_id)
+    query_embedding = None
 
-    if cached_response:
-        print(" Cached response found, returning without API call.")
-        return {"response": cached_response}  #  Return cached response immediately
+    if cached_rows:
+        query_embedding = embed_cache_query(corrected_query)
+        cached_match = match_cached_query(cached_rows, corrected_query, query_embedding)
+
+        if cached_match:
+            record_cache_hit(cached_match["id"])
+            print(" Cached response found, returning without API call.")
+            return {"response": cached_match["response"]}  #  Return cached response immediately
 
     #  Step 2: Retrieve similar invoices from Qdrant
     retrieved_docs = retrieve_similar_docs(corrected_query, top_k=top_k)
@@ -55,8 +98,12 @@ def handle_query(invoice_id, user_query, top_k=3):
     #  Step 3: Generate AI response via LangChain
     ai_response = generate_ai_response(corrected_query, retrieved_docs)
 
-    #  Step 4: Store response ONLY if it's NOT already in cache
-    cache_response(invoice_id, corrected_query, ai_response)
+    #  Never cache a failed call, or the error would be served for every similar question
+    if isinstance(ai_response, dict):
+        return ai_response
+
+    #  Step 4: Store response
+    cache_response(invoice_id, corrected_query, ai_response, query_embedding=query_embedding)
 
     return {"response": ai_response}
 
@@ -67,16 +114,13 @@ def handle_summary(filename: str):
     - If not cached, generates and stores summary.
     """
 
-    # Check if already summarized
     # Step 1: Retrieve relevant document chunks first
     retrieved_docs = retrieve_exact_doc_by_filename(filename)
-    if not retrieved_docs:
-        return {"error": "No relevant document found for summarization."}
 
-    # Step 2: Check if the document seems to be an invoice
-    context = "\n".join([doc.payload["text"] for doc in retrieved_docs])
-    if "invoice" not in context.lower():
-        return {"summary": "The uploaded document does not appear to be an invoice."}
+    # Step 2: Check that there is a document and it seems to be an invoice
+    early_response = check_summary_docs(retrieved_docs)
+    if early_response:
+        return early_response
 
     # Step 3: Check cache (only for invoices)
     cached_summary = get_invoice_summary(filename)
@@ -86,38 +130,112 @@ def handle_summary(filename: str):
 
     # Step 4: Generate and store the summary
     summary_response = generate_summary(filename, retrieved_docs)
-    summary_text = summary_response["text"] if isinstance(summary_response["text"], str) else summary_response[
-        "text"].get("content", "")
+    if "error" in summary_response:
+        return summary_response  # Don't cache failures
+
+    summary_text = summary_text_from(summary_response)
     cache_invoice_summary(filename, summary_text)
 
     return {"summary": summary_text}
 
+
+def handle_field_extraction(filename: str):
+    """
+    Handles structured field extraction and validation for invoices.
+    """
+    retrieved_docs = retrieve_exact_doc_by_filename(filename)
+
     if not retrieved_docs:
-        return {"error": "No relevant invoice found for summarization."}
+        return {"error": "No document found with that filename."}
 
-    # Generate summary using LangChain
-    summary_response = generate_summary(filename, retrieved_docs)
+    structured_data = generate_structured_fields(filename, retrieved_docs)
 
-    # Extract plain text from the response
-    summary_text = summary_response["text"] if isinstance(summary_response["text"], str) else summary_response["text"].get("content", "")
+    return structured_data
+
+
+# -------- ASYNC VARIANTS --------
+# Used by the FastAPI endpoints. Qdrant and OpenRouter calls are awaited natively,
+# the CPU-bound query embedding runs on the embedding pool and SQLite reads/writes
+# are offloaded with asyncio.to_thread so lock waits never hold up embedding work.
+
+async def get_invoice_id_by_filename_async(filename):
+    """
+    Async variant of get_invoice_id_by_filename.
+    """
+    results, _ = await get_async_qdrant().scroll(collection_name=collection_name, limit=100)
+    return invoice_id_from_points(results, filename)
+
+
+async def handle_query_async(invoice_id, user_query, top_k=3):
+    """
+    Async variant of handle_query.
+    """
+    corrected_query = correct_query(user_query)
+
+    cached_rows = await asyncio.to_thread(get_cached_queries, invoice_id)
+    query_embedding = None
+
+    if cached_rows:
+        query_embedding = await run_embedding(embed_cache_query, corrected_query)
+        # Scoring a capped number of rows is cheap enough to run on the event loop
+        cached_match = match_cached_query(cached_rows, corrected_query, query_embedding)
+
+        if cached_match:
+            await asyncio.to_thread(record_cache_hit, cached_match["id"])
+            print(" Cached response found, returning without API call.")
+            return {"response": cached_match["response"]}
+
+    retrieved_docs = await retrieve_similar_docs_async(corrected_query, top_k=top_k)
+
+    if not retrieved_docs:
+        return {"message": "No relevant invoices found."}
 
-    # Cache it
-    #  Cache only if it's a valid invoice summary
-    if "does not appear to be an invoice" not in summary_text.lower():
-        cache_invoice_summary(filename, summary_text)
+    ai_response = await generate_ai_response_async(corrected_query, retrieved_docs)
+
+    if isinstance(ai_response, dict):
+        return ai_response
+
+    if query_embedding is None:
+        query_embedding = await run_embedding(embed_cache_query, corrected_query)
+    await asyncio.to_thread(
+        cache_response, invoice_id, corrected_query, ai_response, query_embedding=query_embedding
+    )
+
+    return {"response": ai_response}
+
+
+async def handle_summary_async(filename: str):
+    """
+    Async variant of handle_summary.
+    """
+    retrieved_docs = await retrieve_exact_doc_by_filename_async(filename)
+
+    early_response = check_summary_docs(retrieved_docs)
+    if early_response:
+        return early_response
+
+    cached_summary = await asyncio.to_thread(get_invoice_summary, filename)
+    if cached_summary:
+        print(" Cached summary found.")
+        return {"summary": cached_summary}
+
+    summary_response = await generate_summary_async(filename, retrieved_docs)
+    if "error" in summary_response:
+        return summary_response
+
+    summary_text = summary_text_from(summary_response)
+    await asyncio.to_thread(cache_invoice_summary, filename, summary_text)
 
     return {"summary": summary_text}
 
 
-def handle_field_extraction(filename: str):
+async def handle_field_extraction_async(filename: str):
     """
-    Handles structured field extraction and validation for invoices.
+    Async variant of handle_field_extraction.
     """
-    retrieved_docs = retrieve_exact_doc_by_filename(filename)
+    retrieved_docs = await retrieve_exact_doc_by_filename_async(filename)
 
     if not retrieved_docs:
         return {"error": "No document found with that filename."}
 
-    structured_data = generate_structured_fields(filename, retrieved_docs)
-
-    return structured_data
\ No newline at end of file
+    return await generate_structured_fields_async(filename, retrieved_docs)
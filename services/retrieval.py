@@ -1,14 +1,52 @@
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from sentence_transformers import SentenceTransformer
+from models.embeddings import run_embedding
 
 # Load the same embedding model used for storing
 embedding_model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
 
 # Connect to the running Qdrant instance
 qdrant = QdrantClient(url="http://localhost:6333")
+_async_qdrant = None
+
+
+def get_async_qdrant():
+    """
+    Shared async Qdrant client, recreated on first use after close_async_qdrant().
+    """
+    global _async_qdrant
+    if _async_qdrant is None:
+        _async_qdrant = AsyncQdrantClient(url="http://localhost:6333")
+    return _async_qdrant
+
+
+async def close_async_qdrant():
+    global _async_qdrant
+    if _async_qdrant is not None:
+        await _async_qdrant.close()
+        _async_qdrant = None
 collection_name = "invoice_embeddings"
 
 
+def encode_query(query):
+    return embedding_model.encode(query, normalize_embeddings=True).tolist()
+
+
+def match_filename(points, filename):
+    """
+    Return the first point whose stored filename matches, with or without the .pdf extension.
+    """
+    filename = filename.lower().strip()
+    variants = {filename, f"{filename}.pdf"}
+
+    for point in points:
+        stored_filename = point.payload.get("filename", "").lower().strip()
+        if stored_filename in variants:
+            return point
+
+    return None
+
+
 def retrieve_similar_docs(query, top_k=3):
     """
     Retrieve the most relevant invoices from Qdrant.
@@ -20,7 +58,7 @@ def retrieve_similar_docs(query, top_k=3):
 
     try:
         # Convert query into an embedding
-        query_vector = embedding_model.encode(query, normalize_embeddings=True).tolist()
+        query_vector = encode_query(query)
 
         # Search for top-k similar vectors in Qdrant
         search_results = qdrant.search(
@@ -40,19 +78,56 @@ def retrieve_similar_docs(query, top_k=3):
 
 
 def retrieve_exact_doc_by_filename(filename: str):
-    filename = filename.lower().strip()
-    variants = {filename, f"{filename}.pdf"}
-
     try:
         results, _ = qdrant.scroll(
             collection_name=collection_name,
             limit=1000
         )
 
-        for point in results:
-            stored_filename = point.payload.get("filename", "").lower().strip()
-            if stored_filename in variants:
-                return [point]
+        point = match_filename(results, filename)
+        if point:
+            return [point]
+
+    except Exception as e:
+        print(f" Error during exact filename match: {e}")
+
+    return []
+
+
+async def retrieve_similar_docs_async(query, top_k=3):
+    """
+    Async variant of retrieve_similar_docs. Encoding runs on the embedding pool.
+    """
+
+    try:
+        query_vector = await run_embedding(encode_query, query)
+
+        search_results = await get_async_qdrant().search(
+            collection_name=collection_name,
+            query_vector=query_vector,
+            limit=top_k,
+        )
+
+        if not search_results:
+            return []
+
+        return search_results
+
+    except Exception as e:
+        print(f"Error retrieving documents from Qdrant: {str(e)}")
+        return []
+
+
+async def retrieve_exact_doc_by_filename_async(filename: str):
+    try:
+        results, _ = await get_async_qdrant().scroll(
+            collection_name=collection_name,
+            limit=1000
+        )
+
+        point = match_filename(results, filename)
+        if point:
+            return [point]
 
     except Exception as e:
         print(f" Error during exact filename match: {e}")